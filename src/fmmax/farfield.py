@@ -7,7 +7,9 @@ zone integration, and batched in-plane wavevectors as generated by
 Copyright (c) Meta Platforms, Inc. and affiliates.
 """
 
-from typing import Callable, Tuple
+import dataclasses
+import functools
+from typing import Callable, Optional, Tuple
 
 import jax
 import jax.numpy as jnp
@@ -23,6 +25,7 @@ def farfield_profile(
     primitive_lattice_vectors: basis.LatticeVectors,
     expansion: basis.Expansion,
     brillouin_grid_axes: Tuple[int, int],
+    fast_math: bool = False,
 ) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
     """Computes a farfield profile.
 
@@ -39,6 +42,9 @@ def farfield_profile(
         expansion: The expansion used for the fields.
         brillouin_grid_axes: Specifies the two axes of `flux` corresponding to
             the Brillouin zone grid.
+        fast_math: If `True`, for single-precision inputs the azimuthal angle is
+            computed with a polynomial approximation of `arctan2`, accurate to a
+            few float32 ULP. Other precisions always use `jnp.arctan2`.
 
     Returns:
         The polar and azimuthal angles, solid angle associated with each value,
@@ -47,6 +53,51 @@ def farfield_profile(
     assert flux.shape[-2] == 2 * expansion.num_terms
     brillouin_grid_axes: Tuple[int, int] = utils.absolute_axes(brillouin_grid_axes, flux.ndim)  # type: ignore[no-redef]
 
+    # Pad the source axis to a bucketed size, so that calls with differing numbers
+    # of sources can share a compiled `_farfield_profile`. Sources are independent,
+    # and so the padding is simply removed from the result. When `flux` is traced,
+    # e.g. when this function is called within a jit-compiled function, the
+    # padding would not avoid any compilation, and so is skipped.
+    num_sources = flux.shape[-1]
+    padded_num_sources = num_sources
+    if not isinstance(flux, jax.core.Tracer):
+        padded_num_sources = _bucketed_num_sources(num_sources)
+    if padded_num_sources != num_sources:
+        pad_width = ((0, 0),) * (flux.ndim - 1) + (
+            (0, padded_num_sources - num_sources),
+        )
+        flux = jnp.pad(flux, pad_width)
+
+    polar_angle, azimuthal_angle, solid_angle, transformed_flux = _farfield_profile(
+        flux=flux,
+        wavelength=wavelength,
+        in_plane_wavevector=in_plane_wavevector,
+        primitive_lattice_vectors=primitive_lattice_vectors,
+        expansion=expansion,
+        brillouin_grid_axes=brillouin_grid_axes,
+        fast_math=fast_math,
+    )
+    if padded_num_sources != num_sources:
+        transformed_flux = transformed_flux[..., :num_sources]
+    return polar_angle, azimuthal_angle, solid_angle, transformed_flux
+
+
+def _bucketed_num_sources(num_sources: int) -> int:
+    """Returns the number of sources rounded up to the next power of two."""
+    return 1 << max(num_sources - 1, 0).bit_length()
+
+
+@functools.partial(jax.jit, static_argnames=("brillouin_grid_axes", "fast_math"))
+def _farfield_profile(
+    flux: jnp.ndarray,
+    wavelength: jnp.ndarray,
+    in_plane_wavevector: jnp.ndarray,
+    primitive_lattice_vectors: basis.LatticeVectors,
+    expansion: basis.Expansion,
+    brillouin_grid_axes: Tuple[int, int],
+    fast_math: bool,
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    """Computes a farfield profile, for absolute `brillouin_grid_axes`."""
     ndim_batch = flux.ndim - 2
     wavelength = utils.atleast_nd(wavelength, ndim_batch)
     in_plane_wavevector = utils.atleast_nd(in_plane_wavevector, ndim_batch + 1)
@@ -56,28 +107,27 @@ def farfield_profile(
         primitive_lattice_vectors=primitive_lattice_vectors,
         expansion=expansion,
     )
-    transverse_wavevectors = unflatten_transverse_wavevectors(
+    transverse_wavevectors = _unflatten_transverse_wavevectors(
         transverse_wavevectors, expansion, brillouin_grid_axes
     )
-    flux = unflatten_flux(flux, expansion, brillouin_grid_axes)
+    flux = _unflatten_flux(flux, expansion, brillouin_grid_axes)
 
     # Remove the brillouin zone axes from `wavelength`, making it compatible
     # with the unflattened flux and transverse wavevectors.
     wavelength = jnp.squeeze(wavelength, axis=brillouin_grid_axes)
 
-    polar_angle, azimuthal_angle = angles_from_unflattened_transverse_wavevectors(
+    polar_angle, azimuthal_angle, solid_angle = _angles_and_solid_angle(
         transverse_wavevectors=transverse_wavevectors,
         wavelength=wavelength,
+        fast_math=fast_math,
     )
 
     # Transform flux form units of power per unit Brillouin zone area to
-    # power per unit solid angle. Add dummy dimensions for the polarization
-    # and sources.
-    solid_angle = solid_angle_from_unflattened_transverse_wavevectors(
-        transverse_wavevectors=transverse_wavevectors,
-        wavelength=wavelength,
-    )
-    transformed_flux = flux / solid_angle[..., jnp.newaxis, jnp.newaxis]
+    # power per unit solid angle. The reciprocal is computed once for each point
+    # in k-space, and then broadcast over the dummy dimensions added for the
+    # polarization and sources.
+    inverse_solid_angle = 1 / solid_angle
+    transformed_flux = flux * inverse_solid_angle[..., jnp.newaxis, jnp.newaxis]
     return polar_angle, azimuthal_angle, solid_angle, transformed_flux
 
 
@@ -99,17 +149,10 @@ def angles_from_unflattened_transverse_wavevectors(
         Arrays containing the polar and azimuthal angles.
     """
     assert transverse_wavevectors.ndim - 3 == wavelength.ndim
-    kx = transverse_wavevectors[..., 0]
-    ky = transverse_wavevectors[..., 1]
-    kt = jnp.sqrt(kx**2 + ky**2)
-
-    sin_polar_angle = kt * wavelength[..., jnp.newaxis, jnp.newaxis] / (2 * jnp.pi)
-    polar_angle = jnp.where(
-        sin_polar_angle > 1, jnp.pi / 2, jnp.arcsin(sin_polar_angle)
+    kx_normalized, ky_normalized, sin_polar_angle_squared = _normalized_wavevectors(
+        transverse_wavevectors, wavelength
     )
-
-    azimuthal_angle = jnp.angle(kx + 1j * ky)
-    return polar_angle, azimuthal_angle
+    return _angles(kx_normalized, ky_normalized, sin_polar_angle_squared)
 
 
 def solid_angle_from_unflattened_transverse_wavevectors(
@@ -130,47 +173,206 @@ def solid_angle_from_unflattened_transverse_wavevectors(
         `transverse_wavevectors`.
     """
     assert transverse_wavevectors.ndim >= 3
+    kx_normalized, ky_normalized, sin_polar_angle_squared = _normalized_wavevectors(
+        transverse_wavevectors, wavelength
+    )
+    return _solid_angle(kx_normalized, ky_normalized, sin_polar_angle_squared)
+
+
+def _angles_and_solid_angle(
+    transverse_wavevectors: jnp.ndarray,
+    wavelength: jnp.ndarray,
+    fast_math: bool = False,
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    """Computes the polar angle, azimuthal angle, and solid angle in one pass.
+
+    Args:
+        transverse_wavevectors: The unflattened transverse wavectors, with
+            shape `(..., nkx, nky, 2)`.
+        wavelength: The free-space wavelength.
+        fast_math: If `True`, the azimuthal angle is computed with `_atan2_fast`.
+
+    Returns:
+        Arrays containing the polar angle, azimuthal angle, and solid angle.
+    """
+    kx_normalized, ky_normalized, sin_polar_angle_squared = _normalized_wavevectors(
+        transverse_wavevectors, wavelength
+    )
+    polar_angle, azimuthal_angle = _angles(
+        kx_normalized, ky_normalized, sin_polar_angle_squared, fast_math
+    )
+    solid_angle = _solid_angle(kx_normalized, ky_normalized, sin_polar_angle_squared)
+    return polar_angle, azimuthal_angle, solid_angle
+
 
-    kx = transverse_wavevectors[..., 0]
-    ky = transverse_wavevectors[..., 1]
+def _normalized_wavevectors(
+    transverse_wavevectors: jnp.ndarray,
+    wavelength: jnp.ndarray,
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    """Normalizes transverse wavevectors by the free-space wavevector.
+
+    Args:
+        transverse_wavevectors: The unflattened transverse wavectors, with
+            shape `(..., nkx, nky, 2)`.
+        wavelength: The free-space wavelength.
+
+    Returns:
+        The normalized `kx` and `ky`, and the squared sine of the polar angle.
+    """
+    # Ensure that intermediate quantities have a consistent precision, avoiding
+    # promotion e.g. of single-precision wavevectors to double precision.
+    dtype = jnp.result_type(transverse_wavevectors, wavelength, jnp.pi)
+    transverse_wavevectors = transverse_wavevectors.astype(dtype)
+    wavelength = wavelength.astype(dtype)
 
     # Normalize the wavevectors so they lie on the unit sphere.
-    kx /= 2 * jnp.pi / wavelength[..., jnp.newaxis, jnp.newaxis]
-    ky /= 2 * jnp.pi / wavelength[..., jnp.newaxis, jnp.newaxis]
-    polar_angle = jnp.arcsin(jnp.sqrt(kx**2 + ky**2))
+    k0 = 2 * jnp.pi / wavelength[..., jnp.newaxis, jnp.newaxis]
+    kx_normalized = transverse_wavevectors[..., 0] / k0
+    ky_normalized = transverse_wavevectors[..., 1] / k0
+    sin_polar_angle_squared = kx_normalized**2 + ky_normalized**2
+    return kx_normalized, ky_normalized, sin_polar_angle_squared
+
+
+def _solid_angle(
+    kx_normalized: jnp.ndarray,
+    ky_normalized: jnp.ndarray,
+    sin_polar_angle_squared: jnp.ndarray,
+) -> jnp.ndarray:
+    """Computes the solid angle from normalized wavevectors.
+
+    Args:
+        kx_normalized: The normalized `kx`, as from `_normalized_wavevectors`.
+        ky_normalized: The normalized `ky`.
+        sin_polar_angle_squared: The squared sine of the polar angle.
+
+    Returns:
+        The solid angle, which is `nan` for evanescent modes.
+    """
 
     # Each of our transverse wavevectors lies within a "cell" in the kxky plane.
     # Compute the area of each cell, and then project it onto the unit sphere
     # to get the solid angle associated with each transverse wavevector.
     #
-    # First, compute the locations of the cell verteces.
-    pad_width = ((0, 0),) * (kx.ndim - 2) + ((1, 1), (1, 1))
-    vertex_kx = jnp.pad(kx, pad_width, mode="edge")
-    vertex_ky = jnp.pad(ky, pad_width, mode="edge")
-    vertex_kx = (
-        vertex_kx[..., :-1, :-1]
-        + vertex_kx[..., :-1, 1:]
-        + vertex_kx[..., 1:, :-1]
-        + vertex_kx[..., 1:, 1:]
-    ) / 4
-    vertex_ky = (
-        vertex_ky[..., :-1, :-1]
-        + vertex_ky[..., :-1, 1:]
-        + vertex_ky[..., 1:, :-1]
-        + vertex_ky[..., 1:, 1:]
-    ) / 4
-    vertex_kt = jnp.stack([vertex_kx, vertex_ky], axis=-1)
+    # First, compute the locations of the cell verteces. Each vertex is the average
+    # of the four surrounding points of the edge-padded k-space grid. Rather than
+    # padding, the edge extension is achieved by clamping the indices of the
+    # neighboring points, and the average is computed separably along the kx and
+    # ky axes. The kx and ky components are handled separately, avoiding the
+    # need to stack them.
+    def _vertices(k: jnp.ndarray) -> jnp.ndarray:
+        for axis in (-2, -1):
+            num = k.shape[axis]
+            lo = onp.clip(onp.arange(num + 1) - 1, 0, num - 1)
+            hi = onp.clip(onp.arange(num + 1), 0, num - 1)
+            k = (jnp.take(k, lo, axis=axis) + jnp.take(k, hi, axis=axis)) / 2
+        return k
+
+    vertex_kx = _vertices(kx_normalized)
+    vertex_ky = _vertices(ky_normalized)
 
     # Find the vectors defining each parallelogramic cell.
-    v1 = vertex_kt[..., :-1, 1:, :] - vertex_kt[..., :-1, :-1, :]
-    v2 = vertex_kt[..., 1:, :-1, :] - vertex_kt[..., :-1, :-1, :]
+    v1x = vertex_kx[..., :-1, 1:] - vertex_kx[..., :-1, :-1]
+    v1y = vertex_ky[..., :-1, 1:] - vertex_ky[..., :-1, :-1]
+    v2x = vertex_kx[..., 1:, :-1] - vertex_kx[..., :-1, :-1]
+    v2y = vertex_ky[..., 1:, :-1] - vertex_ky[..., :-1, :-1]
 
     # Find the area of each parallelogramic cell.
-    cell_area = jnp.abs(v1[..., 0] * v2[..., 1] - v2[..., 0] * v1[..., 1])
+    cell_area = jnp.abs(v1x * v2y - v2x * v1y)
+
+    # Project the area onto the unit sphere, dividing by `cos(polar_angle)`. This
+    # is computed from the unclipped `sin_polar_angle`, so that the solid angle
+    # is `nan` for evanescent modes.
+    return cell_area / jnp.sqrt(1 - sin_polar_angle_squared)
+
+
+def _angles(
+    kx_normalized: jnp.ndarray,
+    ky_normalized: jnp.ndarray,
+    sin_polar_angle_squared: jnp.ndarray,
+    fast_math: bool = False,
+) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    """Computes the polar and azimuthal angles from normalized wavevectors.
+
+    Args:
+        kx_normalized: The normalized `kx`, as from `_normalized_wavevectors`.
+        ky_normalized: The normalized `ky`.
+        sin_polar_angle_squared: The squared sine of the polar angle.
+        fast_math: If `True` and the wavevectors are single-precision, the
+            azimuthal angle is computed with `_atan2_fast`.
+
+    Returns:
+        Arrays containing the polar and azimuthal angles.
+    """
+    # Evanescent modes have `sin_polar_angle > 1`. Clipping gives these a polar
+    # angle of `pi / 2`, without the need for a separate selection.
+    polar_angle = jnp.arcsin(jnp.minimum(jnp.sqrt(sin_polar_angle_squared), 1.0))
+    # The polynomial approximation is only accurate enough for single precision.
+    if fast_math and kx_normalized.dtype == jnp.float32:
+        azimuthal_angle = _atan2_fast(ky_normalized, kx_normalized)
+    else:
+        azimuthal_angle = jnp.arctan2(ky_normalized, kx_normalized)
+    return polar_angle, azimuthal_angle
+
+
+# Coefficients of the odd polynomial approximating `arctan(t)` for `0 <= t <= 1`,
+# i.e. `arctan(t) ~= t * (c0 + c1 * t**2 + c2 * t**4 + ...)`. The coefficients
+# minimize the maximum relative error, which is about `1e-7`.
+_ATAN_COEFFS = (
+    0.999999901,
+    -0.333319908,
+    0.199697248,
+    -0.140194851,
+    0.0991430302,
+    -0.0594865254,
+    0.0242524904,
+    -0.00469329910,
+)
+
 
-    # Project the area onto the unit sphere.
-    projected_area = cell_area / jnp.cos(polar_angle)
-    return projected_area
+@jax.custom_jvp
+def _atan2_fast(y: jnp.ndarray, x: jnp.ndarray) -> jnp.ndarray:
+    """Computes `arctan2(y, x)` using a branchless polynomial approximation.
+
+    The approximation is accurate to a few ULP for single-precision arguments,
+    but not for double precision.
+
+    The arguments are reduced to the first octant using their magnitudes, the
+    arctangent is evaluated with a short polynomial, and the result is mapped
+    back to the correct quadrant using the signs of `x` and `y`.
+
+    Args:
+        y: The y-coordinate.
+        x: The x-coordinate, with shape matching `y`.
+
+    Returns:
+        The angle, in the range `[-pi, pi]`.
+    """
+    abs_x = jnp.abs(x)
+    abs_y = jnp.abs(y)
+    numerator = jnp.minimum(abs_x, abs_y)
+    denominator = jnp.maximum(abs_x, abs_y)
+    t = numerator / jnp.where(denominator == 0, 1, denominator)
+
+    t_squared = t**2
+    poly = jnp.full_like(t, _ATAN_COEFFS[-1])
+    for coeff in _ATAN_COEFFS[-2::-1]:
+        poly = poly * t_squared + coeff
+    angle = poly * t
+
+    angle = jnp.where(abs_y > abs_x, jnp.pi / 2 - angle, angle)
+    angle = jnp.where(jnp.signbit(x), jnp.pi - angle, angle)
+    return jnp.where(jnp.signbit(y), -angle, angle)
+
+
+@_atan2_fast.defjvp
+def _atan2_fast_jvp(
+    primals: Tuple[jnp.ndarray, jnp.ndarray],
+    tangents: Tuple[jnp.ndarray, jnp.ndarray],
+) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    """Computes the jvp for `_atan2_fast`, using the derivatives of `arctan2`."""
+    y, x = primals
+    y_dot, x_dot = tangents
+    return _atan2_fast(y, x), (x * y_dot - y * x_dot) / (x**2 + y**2)
 
 
 # -----------------------------------------------------------------------------
@@ -190,6 +392,12 @@ def integrated_flux(
 ) -> jnp.ndarray:
     """Computes the flux within the bounds defined by `angle_bounds_fn`.
 
+    The integration weights are computed by a jit-compiled function for which
+    `angle_bounds_fn` is a static argument. It should therefore be a hashable
+    callable that is reused across calls, such as a module-level function. Each
+    new callable, e.g. a `lambda` defined inline at the call site, triggers a
+    recompilation and is retained in the compilation cache.
+
     Args:
         flux: The flux array, with shape `(..., num_bz_kx, num_bz_ky, ...
             2 * num_terms, num_sources)`.
@@ -201,8 +409,8 @@ def integrated_flux(
         brillouin_grid_axes: Specifies the two axes of `flux` corresponding to
             the Brillouin zone grid.
         angle_bounds_fn: A function with signature `fn(polar_angle, azimuthal_angle)`
-            returning a mask that is `True` for angles that should be included in
-            the integral.
+            returning a boolean mask that is `True` for angles that should be
+            included in the integral. The angles are always finite.
         upsample_factor: Integer factor specifying upsampling performed in the
             integral, which is used to approximate trapezoidal rule integration.
 
@@ -210,12 +418,15 @@ def integrated_flux(
         The integrated flux, with shape equal to the batch dimensions of flux,
         excluding those for the brillouin zone grid.
     """
+    assert flux.shape[-2] == 2 * expansion.num_terms
     brillouin_grid_axes: Tuple[int, int] = utils.absolute_axes(brillouin_grid_axes, flux.ndim)  # type: ignore[no-redef]
 
     # Compute the weights array, which reduce the integration weights to
-    # an inner product.
+    # an inner product. The weights are independent of the sources, and so only
+    # a single source is passed, so that compiled weights calculations are shared
+    # when the number of sources changes.
     weights = _integrated_flux_weights(
-        flux=flux,
+        flux=flux[..., :1],
         wavelength=wavelength,
         in_plane_wavevector=in_plane_wavevector,
         primitive_lattice_vectors=primitive_lattice_vectors,
@@ -225,10 +436,20 @@ def integrated_flux(
         upsample_factor=upsample_factor,
     )
 
-    # Sum over the Brillouin zone and Fourier order axes.
-    return jnp.sum(weights * flux, axis=brillouin_grid_axes + (-2,))
+    # The weights are identical for both polarizations and all sources, and so
+    # they are broadcast over the polarization and source axes of the flux, which
+    # are split from the Fourier order axis.
+    flux = jnp.reshape(flux, flux.shape[:-2] + (2, expansion.num_terms, flux.shape[-1]))
+    weights = weights[..., jnp.newaxis, :, jnp.newaxis]
 
+    # Sum over the Brillouin zone, polarization, and Fourier order axes.
+    return jnp.sum(weights * flux, axis=brillouin_grid_axes + (-3, -2))
 
+
+@functools.partial(
+    jax.jit,
+    static_argnames=("brillouin_grid_axes", "angle_bounds_fn", "upsample_factor"),
+)
 def _integrated_flux_weights(
     flux: jnp.ndarray,
     wavelength: jnp.ndarray,
@@ -239,32 +460,79 @@ def _integrated_flux_weights(
     angle_bounds_fn: Callable[[jnp.ndarray, jnp.ndarray], jnp.ndarray],
     upsample_factor: int,
 ) -> jnp.ndarray:
-    """Returns the integration weights for the bounds defined by `angle_bounds_fn`."""
-    brillouin_grid_axes: Tuple[int, int] = utils.absolute_axes(brillouin_grid_axes, flux.ndim)  # type: ignore[no-redef]
+    """Returns the integration weights for the bounds defined by `angle_bounds_fn`.
 
-    def _integrated_fn(flux):
-        assert flux.shape[-1] == 1
-        return jnp.sum(
-            _integrated_flux_upsampled(
-                flux=flux,
-                wavelength=wavelength,
-                in_plane_wavevector=in_plane_wavevector,
-                primitive_lattice_vectors=primitive_lattice_vectors,
-                expansion=expansion,
-                brillouin_grid_axes=brillouin_grid_axes,
-                angle_bounds_fn=angle_bounds_fn,
-                upsample_factor=upsample_factor,
-            )
-        )
+    Args:
+        flux: The flux array, with shape `(..., num_bz_kx, num_bz_ky, ...
+            2 * num_terms, num_sources)`. Only its shape and dtype are used.
+        wavelength: The wavelength, batch-compatible with `flux`.
+        in_plane_wavevector: The in-plane wavevector for the zeroth Fourier
+            order, batch-compatible with `flux`.
+        primitive_lattice_vectors: The primitive lattice vectors of the unit cell.
+        expansion: The expansion used for the fields.
+        brillouin_grid_axes: The absolute axes of `flux` corresponding to the
+            Brillouin zone grid.
+        angle_bounds_fn: A function with signature `fn(polar_angle, azimuthal_angle)`
+            returning a boolean mask that is `True` for angles that should be
+            included in the integral. The angles are always finite.
+        upsample_factor: Integer factor specifying upsampling performed in the
+            integral.
+
+    Returns:
+        The weights, with shape `(..., num_bz_kx, num_bz_ky, ..., num_terms)`. The
+        weights are identical for both polarizations and all sources.
+    """
+    assert upsample_factor >= 1
 
-    # The weights are just the gradient of the integrated flux with respect
-    # to the flat array elements; use a dummy flux having a single source.
-    dummy_flux = jnp.ones_like(flux, shape=flux.shape[:-1] + (1,))
-    return jax.grad(_integrated_fn)(dummy_flux)
+    ndim_batch = flux.ndim - 2
+    wavelength = utils.atleast_nd(wavelength, ndim_batch)
+    in_plane_wavevector = utils.atleast_nd(in_plane_wavevector, ndim_batch + 1)
 
+    selected = _upsampled_selection(
+        wavelength=wavelength,
+        in_plane_wavevector=in_plane_wavevector,
+        primitive_lattice_vectors=primitive_lattice_vectors,
+        expansion=expansion,
+        brillouin_grid_axes=brillouin_grid_axes,
+        angle_bounds_fn=angle_bounds_fn,
+        upsample_factor=upsample_factor,
+    )
 
-def _integrated_flux_upsampled(
-    flux: jnp.ndarray,
+    # The integrated flux is linear in `flux`: the flux is unflattened, linearly
+    # upsampled, masked, and summed. The weights are therefore obtained by
+    # applying the transpose of each of these operations to the mask, in reverse
+    # order. The transpose of the separable linear upsampling is a contraction
+    # with the upsampling matrices along the kx and ky axes.
+    dtype = jnp.result_type(flux, jnp.pi)
+    upsample_kx = _linear_upsample_matrix(
+        selected.shape[-2] // upsample_factor, upsample_factor, dtype
+    )
+    upsample_ky = _linear_upsample_matrix(
+        selected.shape[-1] // upsample_factor, upsample_factor, dtype
+    )
+    weights = jnp.einsum(
+        "...ij,ia,jb->...ab",
+        selected.astype(dtype),
+        upsample_kx,
+        upsample_ky,
+    )
+    weights /= upsample_factor**2
+
+    # The transpose of unflattening gathers the weights for each Brillouin zone
+    # grid point and term from the unflattened array.
+    bz_grid_shape = (
+        flux.shape[brillouin_grid_axes[0]],
+        flux.shape[brillouin_grid_axes[1]],
+    )
+    indices = _unflatten_indices(expansion, bz_grid_shape)
+    weights = weights[..., indices.stacked_i, indices.stacked_j]
+    weights = jnp.reshape(
+        weights, weights.shape[:-1] + bz_grid_shape + (expansion.num_terms,)
+    )
+    return jnp.moveaxis(weights, (-3, -2), brillouin_grid_axes)
+
+
+def _upsampled_selection(
     wavelength: jnp.ndarray,
     in_plane_wavevector: jnp.ndarray,
     primitive_lattice_vectors: basis.LatticeVectors,
@@ -273,41 +541,81 @@ def _integrated_flux_upsampled(
     angle_bounds_fn: Callable[[jnp.ndarray, jnp.ndarray], jnp.ndarray],
     upsample_factor: int,
 ) -> jnp.ndarray:
-    """Computes the flux within the bounds defined by `angle_bounds_fn`."""
-    assert upsample_factor >= 1
-    brillouin_grid_axes: Tuple[int, int] = utils.absolute_axes(brillouin_grid_axes, flux.ndim)  # type: ignore[no-redef]
+    """Returns the upsampled mask of k-points within the bounds of `angle_bounds_fn`.
 
-    ndim_batch = flux.ndim - 2
-    wavelength = utils.atleast_nd(wavelength, ndim_batch)
-    in_plane_wavevector = utils.atleast_nd(in_plane_wavevector, ndim_batch + 1)
+    Args:
+        wavelength: The wavelength, with the same number of dimensions as the
+            batch dimensions of the flux.
+        in_plane_wavevector: The in-plane wavevector for the zeroth Fourier
+            order, with one more dimension than `wavelength`.
+        primitive_lattice_vectors: The primitive lattice vectors of the unit cell.
+        expansion: The expansion used for the fields.
+        brillouin_grid_axes: The absolute axes corresponding to the Brillouin
+            zone grid.
+        angle_bounds_fn: A function with signature `fn(polar_angle, azimuthal_angle)`
+            returning a boolean mask that is `True` for angles that should be
+            included.
+        upsample_factor: Integer factor specifying upsampling of the k-space grid.
 
-    transverse_wavevectors = basis.transverse_wavevectors(
+    Returns:
+        The boolean mask, with shape `(..., upsample_factor * num_kx,
+        upsample_factor * num_ky)`.
+    """
+    transverse_wavevectors = _upsampled_unflattened_transverse_wavevectors(
         in_plane_wavevector=in_plane_wavevector,
         primitive_lattice_vectors=primitive_lattice_vectors,
         expansion=expansion,
+        brillouin_grid_axes=brillouin_grid_axes,
+        upsample_factor=upsample_factor,
     )
 
-    flux = unflatten_flux(flux, expansion, brillouin_grid_axes)
-    transverse_wavevectors = unflatten_transverse_wavevectors(
-        transverse_wavevectors, expansion, brillouin_grid_axes
-    )
+    # Remove the brillouin grid axes from wavelength, and insert axes
+    # for the unstacked wavevector.
+    wavelength = jnp.squeeze(wavelength, brillouin_grid_axes)
 
-    # Remove the `nan`s that are found at array locations having no associated
-    # value in the original flattened arrays.
-    flux = jnp.where(jnp.isnan(flux), 0, flux)
-    transverse_wavevectors = jnp.where(
-        jnp.isnan(transverse_wavevectors), 0, transverse_wavevectors
+    # Compute polar and azimuthal angles.
+    polar_angle, azimuthal_angle = angles_from_unflattened_transverse_wavevectors(
+        transverse_wavevectors, wavelength
     )
 
-    # Upsample the transverse wavevectors and flux to high resolution.
-    assert flux.shape[-2] == 2
-    upsampled_flux_shape = flux.shape[:-4] + (
-        upsample_factor * flux.shape[-4],  # kx axis
-        upsample_factor * flux.shape[-3],  # ky axis
-        flux.shape[-2],  # Polarization axis, length 2
-        flux.shape[-1],  # Source axis
+    # Every location of the upsampled grid has a finite wavevector, and hence
+    # finite angles, so that no masking of `nan` values is needed.
+    return angle_bounds_fn(polar_angle, azimuthal_angle)
+
+
+def _upsampled_unflattened_transverse_wavevectors(
+    in_plane_wavevector: jnp.ndarray,
+    primitive_lattice_vectors: basis.LatticeVectors,
+    expansion: basis.Expansion,
+    brillouin_grid_axes: Tuple[int, int],
+    upsample_factor: int,
+) -> jnp.ndarray:
+    """Returns upsampled unflattened transverse wavevectors.
+
+    The wavevectors are unflattened and then linearly upsampled. Locations in the
+    unflattened array having no associated value in the flat wavevectors array
+    are given a wavevector of zero.
+
+    Args:
+        in_plane_wavevector: The in-plane wavevector for the zeroth Fourier order.
+        primitive_lattice_vectors: The primitive lattice vectors of the unit cell.
+        expansion: The expansion used for the fields.
+        brillouin_grid_axes: The absolute axes of `in_plane_wavevector`
+            corresponding to the Brillouin zone grid.
+        upsample_factor: Integer factor specifying upsampling of the k-space grid.
+
+    Returns:
+        The upsampled wavevectors, with shape `(..., upsample_factor * num_kx,
+        upsample_factor * num_ky, 2)`.
+    """
+    transverse_wavevectors = basis.transverse_wavevectors(
+        in_plane_wavevector=in_plane_wavevector,
+        primitive_lattice_vectors=primitive_lattice_vectors,
+        expansion=expansion,
+    )
+    transverse_wavevectors = _unflatten_transverse_wavevectors(
+        transverse_wavevectors, expansion, brillouin_grid_axes, fill_value=0.0
     )
-    flux = jax.image.resize(flux, upsampled_flux_shape, method="linear")
 
     assert transverse_wavevectors.shape[-1] == 2
     upsampled_wavevector_shape = transverse_wavevectors.shape[:-3] + (
@@ -315,27 +623,32 @@ def _integrated_flux_upsampled(
         upsample_factor * transverse_wavevectors.shape[-2],  # ky axis
         transverse_wavevectors.shape[-1],  # Direction axis.
     )
-    transverse_wavevectors = jax.image.resize(
+    return jax.image.resize(
         transverse_wavevectors, upsampled_wavevector_shape, method="linear"
     )
 
-    # Remove the brillouin grid axes from wavelength, and insert axes
-    # for the unstacked wavevector.
-    wavelength = jnp.squeeze(wavelength, brillouin_grid_axes)
 
-    # Compute polar and azimuthal angles.
-    polar_angle, azimuthal_angle = angles_from_unflattened_transverse_wavevectors(
-        transverse_wavevectors, wavelength
-    )
+def _linear_upsample_matrix(
+    num: int,
+    upsample_factor: int,
+    dtype: jnp.dtype,
+) -> jnp.ndarray:
+    """Returns the matrix which performs linear upsampling along one axis.
 
-    selected = angle_bounds_fn(polar_angle, azimuthal_angle)
-    selected = jnp.where(jnp.isnan(selected), False, selected)
-    selected = selected[..., jnp.newaxis, jnp.newaxis]
+    The matrix has shape `(upsample_factor * num, num)`, and its product with
+    an array is equivalent to `jax.image.resize` with `method="linear"`.
 
-    masked_flux = jnp.where(selected, flux, 0)
+    Args:
+        num: The number of elements along the axis before upsampling.
+        upsample_factor: The integer upsampling factor.
+        dtype: The dtype of the matrix.
 
-    # Sum over the kx, ky, and polarization axes.
-    return jnp.sum(masked_flux, axis=(-4, -3, -2)) / upsample_factor**2
+    Returns:
+        The upsampling matrix.
+    """
+    return jax.image.resize(
+        jnp.eye(num, dtype=dtype), (upsample_factor * num, num), method="linear"
+    )
 
 
 # -----------------------------------------------------------------------------
@@ -369,18 +682,173 @@ def unflatten(flat: jnp.ndarray, expansion: basis.Expansion) -> jnp.ndarray:
     """
     assert flat.ndim >= 3
     assert flat.shape[-1] == expansion.num_terms
+    return _unflatten(
+        flat,
+        expansion,
+        brillouin_grid_axes=(flat.ndim - 3, flat.ndim - 2),
+        term_axis=flat.ndim - 1,
+        trailing_axes=(),
+    )
 
-    i = expansion.basis_coefficients[:, 0]
-    j = expansion.basis_coefficients[:, 1]
 
-    batch_shape = flat.shape[:-3]
-    bz_grid_shape = flat.shape[-3:-1]
+def _unflatten(
+    flat: jnp.ndarray,
+    expansion: basis.Expansion,
+    brillouin_grid_axes: Tuple[int, int],
+    term_axis: int,
+    trailing_axes: Tuple[int, ...],
+    fill_value: float = jnp.nan,
+) -> jnp.ndarray:
+    """Unflattens an array with arbitrarily-located Brillouin zone and term axes.
+
+    The axes of the returned array are the batch axes of `flat`, i.e. those not
+    included in `brillouin_grid_axes`, `term_axis`, or `trailing_axes`, followed
+    by the `(num_kx, num_ky)` axes of the unflattened array, followed by the
+    `trailing_axes`. Handling the axes here rather than by transposing `flat`
+    and the unflattened array avoids unnecessary copies.
+
+    Args:
+        flat: The flat array.
+        expansion: The expansion used for the array.
+        brillouin_grid_axes: The absolute axes of `flat` associated with the
+            Brillouin zone grid.
+        term_axis: The absolute axis of `flat` associated with the terms in the
+            Fourier expansion.
+        trailing_axes: The absolute axes of `flat` which are to be the trailing
+            axes of the unflattened array.
+        fill_value: The value given to elements of the unflattened array which
+            have no corresponding element in `flat`.
+
+    Returns:
+        The unflattened array.
+    """
+    assert flat.shape[term_axis] == expansion.num_terms
+    non_batch_axes = brillouin_grid_axes + (term_axis,) + trailing_axes
+    batch_axes = tuple([i for i in range(flat.ndim) if i not in non_batch_axes])
+
+    batch_shape = tuple([flat.shape[i] for i in batch_axes])
+    trailing_shape = tuple([flat.shape[i] for i in trailing_axes])
+    bz_grid_shape = (
+        flat.shape[brillouin_grid_axes[0]],
+        flat.shape[brillouin_grid_axes[1]],
+    )
+    dtype = jnp.result_type(flat, jnp.nan)
+
+    indices = _unflatten_indices(expansion, bz_grid_shape)
+    num_i, num_j = indices.rectangle_shape
 
     # The shape of the output array shoudl accomodate all `(i, j)` values.
-    shape = batch_shape + (
-        (max(i) - min(i) + 1) * bz_grid_shape[0],
-        (max(j) - min(j) + 1) * bz_grid_shape[1],
+    shape = (
+        batch_shape
+        + (num_i * bz_grid_shape[0], num_j * bz_grid_shape[1])
+        + trailing_shape
+    )
+
+    # When the expansion fills a complete `(num_i, num_j)` rectangle, e.g. for
+    # a parallelogramic truncation, the unflattened array is simply a permutation
+    # of `flat` and can be obtained by reshaping and transposing. This avoids the
+    # gather operation and the fill values needed for sparse expansions.
+    if indices.rectangle_order is not None:
+        # Split the term axis into `(num_i, num_j)` axes in-place. The axes
+        # following the term axis are shifted by one.
+        rectangle = jnp.take(flat, indices.rectangle_order, axis=term_axis)
+        rectangle = jnp.reshape(
+            rectangle,
+            flat.shape[:term_axis] + (num_i, num_j) + flat.shape[term_axis + 1 :],
+        )
+
+        def shifted(axes: Tuple[int, ...]) -> Tuple[int, ...]:
+            return tuple([a + (a > term_axis) for a in axes])
+
+        bz_i, bz_j = shifted(brillouin_grid_axes)
+        axes = (
+            shifted(batch_axes)
+            + (term_axis, bz_i, term_axis + 1, bz_j)
+            + shifted(trailing_axes)
+        )
+        return jnp.reshape(jnp.transpose(rectangle, axes), shape).astype(dtype)
+
+    # Transpose so that the Brillouin zone grid and term axes are contiguous,
+    # and flatten them into a single axis.
+    axes = batch_axes + brillouin_grid_axes + (term_axis,) + trailing_axes
+    stacked_flat = jnp.transpose(flat, axes).astype(dtype)
+    stacked_flat = jnp.reshape(stacked_flat, batch_shape + (-1,) + trailing_shape)
+
+    # Gather the values for each location in the unflattened array. This is
+    # equivalent to scattering into a filled array, but gathers are
+    # considerably faster than scatters, particularly on CPU. Locations having
+    # no associated value have an out-of-range index, and are given `fill_value`.
+    unflattened = jnp.take(
+        stacked_flat,
+        indices.gather_index,
+        axis=len(batch_shape),
+        mode="fill",
+        fill_value=fill_value,
     )
+    return jnp.reshape(unflattened, shape)
+
+
+@dataclasses.dataclass(frozen=True)
+class _UnflattenIndices:
+    """Stores the indices used to unflatten arrays for a given expansion.
+
+    Attributes:
+        rectangle_order: The order of terms which arranges them in a
+            `(num_i, num_j)` rectangle, or `None` if the expansion does not fill
+            a rectangle.
+        stacked_i: The first index into the unflattened array for each element
+            of the flattened Brillouin zone grid and term axes.
+        stacked_j: The second index into the unflattened array.
+        gather_index: The index into the flattened Brillouin zone grid and term
+            axes for each element of the flattened unflattened array. Locations
+            having no associated value are given the index one past the last
+            element of the flattened axes.
+        rectangle_shape: The shape `(num_i, num_j)` of the rectangle containing
+            all the basis coefficients.
+    """
+
+    rectangle_order: Optional[onp.ndarray]
+    stacked_i: onp.ndarray
+    stacked_j: onp.ndarray
+    gather_index: onp.ndarray
+    rectangle_shape: Tuple[int, int]
+
+
+def _unflatten_indices(
+    expansion: basis.Expansion,
+    bz_grid_shape: Tuple[int, int],
+) -> _UnflattenIndices:
+    """Returns the indices used to unflatten arrays for the given expansion.
+
+    The indices depend only on the expansion and the Brillouin zone grid shape,
+    and so they are cached to avoid recomputation on each call.
+
+    Args:
+        expansion: The expansion used for the flat array.
+        bz_grid_shape: The shape of the Brillouin zone grid.
+
+    Returns:
+        The `_UnflattenIndices`.
+    """
+    coefficients = tuple(map(tuple, expansion.basis_coefficients.tolist()))
+    return _unflatten_indices_cached(coefficients, tuple(bz_grid_shape))
+
+
+@functools.lru_cache(maxsize=128)
+def _unflatten_indices_cached(
+    coefficients: Tuple[Tuple[int, int], ...],
+    bz_grid_shape: Tuple[int, int],
+) -> _UnflattenIndices:
+    """Computes the indices for `_unflatten_indices`."""
+    i, j = onp.asarray(coefficients).T
+
+    num_i = int(max(i) - min(i) + 1)
+    num_j = int(max(j) - min(j) + 1)
+
+    rectangle_index = (i - min(i)) * num_j + (j - min(j))
+    rectangle_order: Optional[onp.ndarray] = None
+    if onp.array_equal(onp.sort(rectangle_index), onp.arange(num_i * num_j)):
+        rectangle_order = onp.argsort(rectangle_index)
 
     bz_i, bz_j = onp.meshgrid(
         onp.arange(bz_grid_shape[0]),
@@ -396,9 +864,26 @@ def unflatten(flat: jnp.ndarray, expansion: basis.Expansion) -> jnp.ndarray:
 
     stacked_i = merged_i.flatten()
     stacked_j = merged_j.flatten()
-    stacked_flat = jnp.reshape(flat, batch_shape + (-1,))
 
-    return jnp.full(shape, jnp.nan).at[..., stacked_i, stacked_j].set(stacked_flat)
+    num_stacked = stacked_i.size
+    gather_index = onp.full(
+        (num_i * bz_grid_shape[0]) * (num_j * bz_grid_shape[1]), num_stacked
+    )
+    gather_index[stacked_i * num_j * bz_grid_shape[1] + stacked_j] = onp.arange(
+        num_stacked
+    )
+
+    # Prevent modification of the cached arrays.
+    for arr in (rectangle_order, stacked_i, stacked_j, gather_index):
+        if arr is not None:
+            arr.flags.writeable = False
+    return _UnflattenIndices(
+        rectangle_order=rectangle_order,
+        stacked_i=stacked_i,
+        stacked_j=stacked_j,
+        gather_index=gather_index,
+        rectangle_shape=(num_i, num_j),
+    )
 
 
 def unflatten_flux(
@@ -420,24 +905,26 @@ def unflatten_flux(
     assert flux.ndim >= 4
     assert flux.shape[-2] == 2 * expansion.num_terms
     brillouin_grid_axes: Tuple[int, int] = utils.absolute_axes(brillouin_grid_axes, flux.ndim)  # type: ignore[no-redef]
+    return _unflatten_flux(flux, expansion, brillouin_grid_axes)
+
 
+def _unflatten_flux(
+    flux: jnp.ndarray,
+    expansion: basis.Expansion,
+    brillouin_grid_axes: Tuple[int, int],
+) -> jnp.ndarray:
+    """Unflattens a flux, for absolute `brillouin_grid_axes`."""
     # The flux array has values for two polarizations at each Fourier order. Split
-    # these and treat them as a batch dimension.
+    # these into a separate polarization axis, which along with the source axis
+    # becomes a trailing axis of the unflattened flux.
     flux = jnp.reshape(flux, flux.shape[:-2] + (2, -1, flux.shape[-1]))
-
-    # Transpose so the axes associated with the Fourier orders and Brillouin zone
-    # grid are the trailing axes, as needed by `unflatten`.
-    batch_axes = tuple(
-        [i for i in range(flux.ndim) if i not in brillouin_grid_axes + (flux.ndim - 2,)]
+    return _unflatten(
+        flux,
+        expansion,
+        brillouin_grid_axes=brillouin_grid_axes,
+        term_axis=flux.ndim - 2,
+        trailing_axes=(flux.ndim - 3, flux.ndim - 1),
     )
-    axes = batch_axes + tuple([i for i in range(flux.ndim) if i not in batch_axes])
-    flux = jnp.transpose(flux, axes)
-
-    flux = unflatten(flux, expansion)
-
-    # Transpose so that polarization and sources are returned to the trailing axes.
-    axes = tuple(range(flux.ndim - 4)) + (-2, -1, -4, -3)
-    return jnp.transpose(flux, axes)
 
 
 def unflatten_transverse_wavevectors(
@@ -459,20 +946,24 @@ def unflatten_transverse_wavevectors(
     assert transverse_wavevectors.ndim >= 4
     assert transverse_wavevectors.shape[-2:] == (expansion.num_terms, 2)
     brillouin_grid_axes: Tuple[int, int] = utils.absolute_axes(brillouin_grid_axes, transverse_wavevectors.ndim)  # type: ignore[no-redef]
-
-    # Transpose so the axes associated with the Fourier orders and Brillouin zone
-    # grid are the trailing axes, as needed by `unflatten`.
-    non_batch_axes = brillouin_grid_axes + (transverse_wavevectors.ndim - 2,)
-    batch_axes = tuple(
-        [i for i in range(transverse_wavevectors.ndim) if i not in non_batch_axes]
-    )
-    axes = batch_axes + tuple(
-        [i for i in range(transverse_wavevectors.ndim) if i not in batch_axes]
+    return _unflatten_transverse_wavevectors(
+        transverse_wavevectors, expansion, brillouin_grid_axes
     )
-    transverse_wavevectors = jnp.transpose(transverse_wavevectors, axes)
 
-    transverse_wavevectors = unflatten(transverse_wavevectors, expansion)
 
-    # Transpose so the trailing axis is for the wavevector direction.
-    axes = tuple(range(transverse_wavevectors.ndim - 3)) + (-2, -1, -3)
-    return jnp.transpose(transverse_wavevectors, axes)
+def _unflatten_transverse_wavevectors(
+    transverse_wavevectors: jnp.ndarray,
+    expansion: basis.Expansion,
+    brillouin_grid_axes: Tuple[int, int],
+    fill_value: float = jnp.nan,
+) -> jnp.ndarray:
+    """Unflattens transverse wavevectors, for absolute `brillouin_grid_axes`."""
+    # The wavevector direction axis becomes the trailing axis.
+    return _unflatten(
+        transverse_wavevectors,
+        expansion,
+        brillouin_grid_axes=brillouin_grid_axes,
+        term_axis=transverse_wavevectors.ndim - 2,
+        trailing_axes=(transverse_wavevectors.ndim - 1,),
+        fill_value=fill_value,
+    )
@@ -7,6 +7,7 @@ import functools
 import unittest
 
 import jax
+import jax.experimental
 import jax.numpy as jnp
 import numpy as onp
 import parameterized
@@ -14,6 +15,27 @@ import parameterized
 from fmmax import basis, farfield, fields, fmm, scattering, sources, utils
 
 
+# Angle bounds functions are static arguments of the jit-compiled integrated flux
+# calculation, and so they are defined at module level for reuse across tests.
+def _all_angles(polar_angle, azimuthal_angle):
+    del azimuthal_angle
+    return jnp.full(polar_angle.shape, True)
+
+
+def _polar_angle_below_half(polar_angle, azimuthal_angle):
+    del azimuthal_angle
+    return polar_angle < 0.5
+
+
+def _propagating(polar_angle, azimuthal_angle):
+    del azimuthal_angle
+    return polar_angle < 1.5
+
+
+def _upper_half_cone(polar_angle, azimuthal_angle):
+    return (polar_angle < 0.3 * jnp.pi) & (azimuthal_angle > 0)
+
+
 class FarfieldProfileTest(unittest.TestCase):
     def test_dipole_farfield_matches_analytical_calculation(self):
         # Calculate the farfield for a dipole in vacuum, and compare to an analytical result.
@@ -94,6 +116,121 @@ class FarfieldProfileTest(unittest.TestCase):
             rtol=1e-5,
         )
 
+    @parameterized.parameterized.expand(([1], [3], [5]))
+    def test_farfield_matches_for_individual_sources(self, num_sources):
+        # Checks that padding of the source axis does not affect the result.
+        primitive_lattice_vectors = basis.LatticeVectors(basis.X, basis.Y)
+        expansion = basis.generate_expansion(
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            approximate_num_terms=50,
+            truncation=basis.Truncation.CIRCULAR,
+        )
+        in_plane_wavevector = basis.brillouin_zone_in_plane_wavevector(
+            (3, 3), primitive_lattice_vectors
+        )
+        flux = jax.random.uniform(
+            jax.random.PRNGKey(0), (3, 3, 2 * expansion.num_terms, num_sources)
+        )
+        farfield_fn = functools.partial(
+            farfield.farfield_profile,
+            wavelength=jnp.asarray(0.63),
+            in_plane_wavevector=in_plane_wavevector,
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            expansion=expansion,
+            brillouin_grid_axes=(0, 1),
+        )
+        *_, farfield_flux = farfield_fn(flux=flux)
+        self.assertEqual(farfield_flux.shape[-1], num_sources)
+        for i in range(num_sources):
+            *_, expected = farfield_fn(flux=flux[..., i : i + 1])
+            onp.testing.assert_array_equal(farfield_flux[..., i : i + 1], expected)
+
+    def test_source_axis_not_padded_when_traced(self):
+        primitive_lattice_vectors = basis.LatticeVectors(basis.X, basis.Y)
+        expansion = basis.generate_expansion(
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            approximate_num_terms=50,
+            truncation=basis.Truncation.CIRCULAR,
+        )
+        in_plane_wavevector = basis.brillouin_zone_in_plane_wavevector(
+            (3, 3), primitive_lattice_vectors
+        )
+        flux = jnp.ones((3, 3, 2 * expansion.num_terms, 5))
+
+        @jax.jit
+        def farfield_fn(flux):
+            return farfield.farfield_profile(
+                flux=flux,
+                wavelength=jnp.asarray(0.63),
+                in_plane_wavevector=in_plane_wavevector,
+                primitive_lattice_vectors=primitive_lattice_vectors,
+                expansion=expansion,
+                brillouin_grid_axes=(0, 1),
+            )
+
+        jaxpr = jax.make_jaxpr(farfield_fn)(flux)
+        self.assertNotIn("pad", str(jaxpr))
+        *_, farfield_flux = farfield_fn(flux)
+        self.assertEqual(farfield_flux.shape[-1], 5)
+
+    def test_fast_math_matches_default(self):
+        primitive_lattice_vectors = basis.LatticeVectors(basis.X, basis.Y)
+        expansion = basis.generate_expansion(
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            approximate_num_terms=50,
+            truncation=basis.Truncation.CIRCULAR,
+        )
+        in_plane_wavevector = basis.brillouin_zone_in_plane_wavevector(
+            (3, 3), primitive_lattice_vectors
+        )
+        flux = jax.random.uniform(
+            jax.random.PRNGKey(0), (3, 3, 2 * expansion.num_terms, 1)
+        )
+        farfield_fn = functools.partial(
+            farfield.farfield_profile,
+            flux=flux,
+            wavelength=jnp.asarray(0.63),
+            in_plane_wavevector=in_plane_wavevector,
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            expansion=expansion,
+            brillouin_grid_axes=(0, 1),
+        )
+        expected = farfield_fn()
+        result = farfield_fn(fast_math=True)
+        for r, e in zip(result, expected):
+            onp.testing.assert_allclose(r, e, rtol=1e-6, atol=1e-6)
+
+    def test_single_precision_inputs_not_promoted(self):
+        with jax.experimental.enable_x64():
+            primitive_lattice_vectors = basis.LatticeVectors(
+                basis.X.astype(jnp.float32), basis.Y.astype(jnp.float32)
+            )
+            expansion = basis.generate_expansion(
+                primitive_lattice_vectors=primitive_lattice_vectors,
+                approximate_num_terms=50,
+                truncation=basis.Truncation.CIRCULAR,
+            )
+            in_plane_wavevector = basis.brillouin_zone_in_plane_wavevector(
+                (3, 3), primitive_lattice_vectors
+            ).astype(jnp.float32)
+            flux = jnp.ones((3, 3, 2 * expansion.num_terms, 1), jnp.float32)
+            kwargs = dict(
+                flux=flux,
+                wavelength=jnp.asarray(0.63, jnp.float32),
+                in_plane_wavevector=in_plane_wavevector,
+                primitive_lattice_vectors=primitive_lattice_vectors,
+                expansion=expansion,
+                brillouin_grid_axes=(0, 1),
+            )
+            for result in farfield.farfield_profile(**kwargs):
+                self.assertEqual(result.dtype, jnp.float32)
+            integrated_flux = farfield.integrated_flux(
+                angle_bounds_fn=_polar_angle_below_half,
+                upsample_factor=2,
+                **kwargs,
+            )
+            self.assertEqual(integrated_flux.dtype, jnp.float32)
+
     @parameterized.parameterized.expand(
         (
             [(1, 1), (0, 1), jnp.pi / 2],
@@ -201,6 +338,101 @@ class FarfieldProfileTest(unittest.TestCase):
         )
 
 
+class Atan2FastTest(unittest.TestCase):
+    def test_matches_arctan2(self):
+        y, x = jax.random.normal(jax.random.PRNGKey(0), (2, 1000))
+        # Include the axes and the signed zeros.
+        values = jnp.asarray([0.0, -0.0, 1.0, -1.0])
+        y = jnp.concatenate([y, jnp.repeat(values, 4)])
+        x = jnp.concatenate([x, jnp.tile(values, 4)])
+        onp.testing.assert_allclose(
+            farfield._atan2_fast(y, x), jnp.arctan2(y, x), rtol=1e-6, atol=1e-6
+        )
+
+    def test_fast_math_double_precision_uses_arctan2(self):
+        with jax.experimental.enable_x64():
+            y, x = jax.random.normal(
+                jax.random.PRNGKey(0), (2, 1, 10, 10), dtype=jnp.float64
+            )
+            transverse_wavevectors = jnp.stack([x, y], axis=-1)
+            _, azimuthal_angle, _ = farfield._angles_and_solid_angle(
+                transverse_wavevectors, jnp.ones((1,)), fast_math=True
+            )
+            _, expected, _ = farfield._angles_and_solid_angle(
+                transverse_wavevectors, jnp.ones((1,)), fast_math=False
+            )
+        self.assertEqual(azimuthal_angle.dtype, jnp.float64)
+        onp.testing.assert_array_equal(azimuthal_angle, expected)
+
+    def test_gradient_matches_arctan2(self):
+        y, x = jax.random.normal(jax.random.PRNGKey(0), (2, 100))
+        grad = jax.grad(lambda y, x: jnp.sum(farfield._atan2_fast(y, x)), (0, 1))
+        expected_grad = jax.grad(lambda y, x: jnp.sum(jnp.arctan2(y, x)), (0, 1))
+        for g, e in zip(grad(y, x), expected_grad(y, x)):
+            onp.testing.assert_allclose(g, e, rtol=1e-5)
+
+
+def _integrated_flux_reference(
+    flux,
+    wavelength,
+    in_plane_wavevector,
+    primitive_lattice_vectors,
+    expansion,
+    brillouin_grid_axes,
+    angle_bounds_fn,
+    upsample_factor,
+):
+    # Directly computes the integrated flux by unflattening and upsampling the
+    # flux and wavevectors, and summing the flux for the selected angles. This
+    # serves as a reference for the weights computed by `integrated_flux`.
+    brillouin_grid_axes = utils.absolute_axes(brillouin_grid_axes, flux.ndim)
+    ndim_batch = flux.ndim - 2
+    wavelength = utils.atleast_nd(wavelength, ndim_batch)
+    in_plane_wavevector = utils.atleast_nd(in_plane_wavevector, ndim_batch + 1)
+
+    transverse_wavevectors = basis.transverse_wavevectors(
+        in_plane_wavevector=in_plane_wavevector,
+        primitive_lattice_vectors=primitive_lattice_vectors,
+        expansion=expansion,
+    )
+    flux = farfield.unflatten_flux(flux, expansion, brillouin_grid_axes)
+    transverse_wavevectors = farfield.unflatten_transverse_wavevectors(
+        transverse_wavevectors, expansion, brillouin_grid_axes
+    )
+    flux = jnp.where(jnp.isnan(flux), 0, flux)
+    transverse_wavevectors = jnp.where(
+        jnp.isnan(transverse_wavevectors), 0, transverse_wavevectors
+    )
+
+    flux = jax.image.resize(
+        flux,
+        flux.shape[:-4]
+        + (upsample_factor * flux.shape[-4], upsample_factor * flux.shape[-3])
+        + flux.shape[-2:],
+        method="linear",
+    )
+    transverse_wavevectors = jax.image.resize(
+        transverse_wavevectors,
+        transverse_wavevectors.shape[:-3]
+        + (
+            upsample_factor * transverse_wavevectors.shape[-3],
+            upsample_factor * transverse_wavevectors.shape[-2],
+        )
+        + transverse_wavevectors.shape[-1:],
+        method="linear",
+    )
+
+    wavelength = jnp.squeeze(wavelength, brillouin_grid_axes)
+    polar_angle, azimuthal_angle = (
+        farfield.angles_from_unflattened_transverse_wavevectors(
+            transverse_wavevectors, wavelength
+        )
+    )
+    selected = angle_bounds_fn(polar_angle, azimuthal_angle)
+    masked_flux = jnp.where(selected[..., jnp.newaxis, jnp.newaxis], flux, 0)
+    return jnp.sum(masked_flux, axis=(-4, -3, -2)) / upsample_factor**2
+
+
 class IntegratedFluxTest(unittest.TestCase):
     def test_resize(self):
         # Directly tests resizing, as this can fail if some GPU libraries are missing.
@@ -249,10 +481,6 @@ class IntegratedFluxTest(unittest.TestCase):
             axis=[i for i in range(len(batch_shape)) if i not in brillouin_grid_axes],
         )
 
-        def angle_bounds_fn(polar_angle, azimuthal_angle):
-            del azimuthal_angle
-            return jnp.full(polar_angle.shape, True)
-
         # Calculate the integrated flux by the default method, which first
         # computes weights and then does the integration by taking the weighted
         # sum of flux.
@@ -263,23 +491,151 @@ class IntegratedFluxTest(unittest.TestCase):
             primitive_lattice_vectors=primitive_lattice_vectors,
             expansion=expansion,
             brillouin_grid_axes=brillouin_grid_axes,
-            angle_bounds_fn=angle_bounds_fn,
+            angle_bounds_fn=_all_angles,
             upsample_factor=upsample_factor,
         )
 
         # Compute the integrated flux directly.
-        integrated_flux_direct = farfield._integrated_flux_upsampled(
+        integrated_flux_direct = _integrated_flux_reference(
             flux=flux,
             wavelength=wavelength,
             in_plane_wavevector=in_plane_wavevector,
             primitive_lattice_vectors=primitive_lattice_vectors,
             expansion=expansion,
             brillouin_grid_axes=brillouin_grid_axes,
-            angle_bounds_fn=angle_bounds_fn,
+            angle_bounds_fn=_all_angles,
             upsample_factor=upsample_factor,
         )
         onp.testing.assert_allclose(integrated_flux, integrated_flux_direct, rtol=1e-6)
 
+    @parameterized.parameterized.expand(
+        (
+            [(4, 4), (0, 1), 1],
+            [(2, 4, 4), (1, 2), 3],
+            [(4, 2, 4), (0, 2), 2],
+        )
+    )
+    def test_weights_match_gradient(
+        self, batch_shape, brillouin_grid_axes, upsample_factor
+    ):
+        # Checks that the weights match the gradient of the integrated flux
+        # with respect to the flux, which is the definition of the weights.
+        primitive_lattice_vectors = basis.LatticeVectors(basis.X * 3, basis.Y)
+        expansion = basis.generate_expansion(
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            approximate_num_terms=100,
+            truncation=basis.Truncation.CIRCULAR,
+        )
+        flux = jnp.ones(batch_shape + (2 * expansion.num_terms, 1))
+        wavelength = 0.5 + jax.random.uniform(
+            jax.random.PRNGKey(1),
+            [(1 if i in brillouin_grid_axes else d) for i, d in enumerate(batch_shape)],
+        )
+        in_plane_wavevector = basis.brillouin_zone_in_plane_wavevector(
+            brillouin_grid_shape=tuple([batch_shape[i] for i in brillouin_grid_axes]),
+            primitive_lattice_vectors=primitive_lattice_vectors,
+        )
+        in_plane_wavevector = jnp.expand_dims(
+            in_plane_wavevector,
+            axis=[i for i in range(len(batch_shape)) if i not in brillouin_grid_axes],
+        )
+
+        kwargs = dict(
+            wavelength=wavelength,
+            in_plane_wavevector=in_plane_wavevector,
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            expansion=expansion,
+            brillouin_grid_axes=brillouin_grid_axes,
+            angle_bounds_fn=_upper_half_cone,
+            upsample_factor=upsample_factor,
+        )
+        weights = farfield._integrated_flux_weights(flux=flux, **kwargs)
+        expected_weights = jax.grad(
+            lambda x: jnp.sum(_integrated_flux_reference(flux=x, **kwargs))
+        )(flux)
+        self.assertGreater(jnp.sum(expected_weights), 0)
+        # The weights are identical for both polarizations and all sources.
+        weights = jnp.concatenate([weights, weights], axis=-1)[..., jnp.newaxis]
+        onp.testing.assert_allclose(
+            jnp.broadcast_to(weights, expected_weights.shape),
+            expected_weights,
+            atol=1e-6,
+        )
+
+    @parameterized.parameterized.expand(
+        (
+            [(1, 1), 1, basis.Truncation.PARALLELOGRAMIC],
+            [(3, 4), 1, basis.Truncation.PARALLELOGRAMIC],
+            [(3, 4), 3, basis.Truncation.PARALLELOGRAMIC],
+            [(1, 1), 3, basis.Truncation.CIRCULAR],
+            [(3, 4), 3, basis.Truncation.CIRCULAR],
+        )
+    )
+    def test_upsampled_wavevectors_match_resized(
+        self, bz_shape, upsample_factor, truncation
+    ):
+        primitive_lattice_vectors = basis.LatticeVectors(
+            basis.X * 3 + basis.Y * 0.5, basis.Y
+        )
+        expansion = basis.generate_expansion(
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            approximate_num_terms=50,
+            truncation=truncation,
+        )
+        in_plane_wavevector = basis.brillouin_zone_in_plane_wavevector(
+            brillouin_grid_shape=bz_shape,
+            primitive_lattice_vectors=primitive_lattice_vectors,
+        )
+        in_plane_wavevector += jnp.asarray([0.3, -0.2])
+        transverse_wavevectors = farfield.unflatten_transverse_wavevectors(
+            basis.transverse_wavevectors(
+                in_plane_wavevector=in_plane_wavevector,
+                primitive_lattice_vectors=primitive_lattice_vectors,
+                expansion=expansion,
+            ),
+            expansion,
+            brillouin_grid_axes=(0, 1),
+        )
+        # Locations having no associated wavevector are given a value of zero.
+        transverse_wavevectors = jnp.where(
+            jnp.isnan(transverse_wavevectors), 0, transverse_wavevectors
+        )
+        nkx, nky, _ = transverse_wavevectors.shape
+        expected = jax.image.resize(
+            transverse_wavevectors,
+            (upsample_factor * nkx, upsample_factor * nky, 2),
+            method="linear",
+        )
+        upsampled = farfield._upsampled_unflattened_transverse_wavevectors(
+            in_plane_wavevector=in_plane_wavevector,
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            expansion=expansion,
+            brillouin_grid_axes=(0, 1),
+            upsample_factor=upsample_factor,
+        )
+        onp.testing.assert_allclose(upsampled, expected, atol=1e-5)
+
+    def test_malformed_flux_raises(self):
+        primitive_lattice_vectors = basis.LatticeVectors(basis.X, basis.Y)
+        expansion = basis.generate_expansion(
+            primitive_lattice_vectors=primitive_lattice_vectors,
+            approximate_num_terms=50,
+            truncation=basis.Truncation.CIRCULAR,
+        )
+        with self.assertRaises(AssertionError):
+            farfield.integrated_flux(
+                flux=jnp.ones((3, 3, expansion.num_terms, 2)),
+                wavelength=jnp.asarray([[0.63]]),
+                in_plane_wavevector=basis.brillouin_zone_in_plane_wavevector(
+                    (3, 3), primitive_lattice_vectors
+                ),
+                primitive_lattice_vectors=primitive_lattice_vectors,
+                expansion=expansion,
+                brillouin_grid_axes=(0, 1),
+                angle_bounds_fn=_propagating,
+                upsample_factor=3,
+            )
+
     def test_upsample_scale(self):
         # Check that scaling of the integrated power when using upsampling is correct.
         primitive_lattice_vectors = basis.LatticeVectors(basis.X * 3, basis.Y)
@@ -298,10 +654,6 @@ class IntegratedFluxTest(unittest.TestCase):
             primitive_lattice_vectors=primitive_lattice_vectors,
         )
 
-        def angle_bounds_fn(polar_angle, azimuthal_angle):
-            del azimuthal_angle
-            return jnp.full(polar_angle.shape, True)
-
         integrated_flux_fn = functools.partial(
             farfield.integrated_flux,
             flux=flux,
@@ -310,7 +662,7 @@ class IntegratedFluxTest(unittest.TestCase):
             primitive_lattice_vectors=primitive_lattice_vectors,
             expansion=expansion,
             brillouin_grid_axes=(0, 1),
-            angle_bounds_fn=angle_bounds_fn,
+            angle_bounds_fn=_all_angles,
         )
         integrated_flux_no_upsample = integrated_flux_fn(upsample_factor=1)
         integrated_flux_upsample = integrated_flux_fn(upsample_factor=10)
@@ -391,7 +743,7 @@ class IntegratedFluxTest(unittest.TestCase):
             primitive_lattice_vectors=primitive_lattice_vectors,
             expansion=expansion,
             brillouin_grid_axes=(0, 1),
-            angle_bounds_fn=lambda polar_angle, _: jnp.full(polar_angle.shape, True),
+            angle_bounds_fn=_all_angles,
             upsample_factor=10,
         )
         onp.testing.assert_allclose(
@@ -445,6 +797,66 @@ class UnflattenTest(unittest.TestCase):
         )
         onp.testing.assert_array_equal(expected, unstacked)
 
+    @parameterized.parameterized.expand(
+        (
+            [basis.Truncation.CIRCULAR, (2, 3)],
+            [basis.Truncation.CIRCULAR, (1, 3, 2)],
+            [basis.Truncation.PARALLELOGRAMIC, (2, 3)],
+            [basis.Truncation.PARALLELOGRAMIC, (1, 3, 2)],
+        )
+    )
+    def test_unflatten_matches_reference(self, truncation, batch_shape):
+        expansion = basis.generate_expansion(
+            primitive_lattice_vectors=basis.LatticeVectors(basis.X * 3, basis.Y),
+            approximate_num_terms=100,
+            truncation=truncation,
+        )
+        data = jax.random.uniform(
+            jax.random.PRNGKey(0), batch_shape + (expansion.num_terms,)
+        )
+        unstacked = farfield.unflatten(data, expansion)
+
+        # Compute the expected unflattened array by explicitly assigning each
+        # element of `data` to its location in the unflattened array.
+        i = expansion.basis_coefficients[:, 0] - onp.amin(
+            expansion.basis_coefficients[:, 0]
+        )
+        j = expansion.basis_coefficients[:, 1] - onp.amin(
+            expansion.basis_coefficients[:, 1]
+        )
+        num_bz_kx, num_bz_ky = batch_shape[-2:]
+        expected = onp.full(
+            batch_shape[:-2]
+            + ((onp.amax(i) + 1) * num_bz_kx, (onp.amax(j) + 1) * num_bz_ky),
+            onp.nan,
+        )
+        for bz_i in range(num_bz_kx):
+            for bz_j in range(num_bz_ky):
+                expected[..., i * num_bz_kx + bz_i, j * num_bz_ky + bz_j] = data[
+                    ..., bz_i, bz_j, :
+                ]
+        onp.testing.assert_array_equal(unstacked, expected)
+
+    @parameterized.parameterized.expand(
+        [[basis.Truncation.CIRCULAR], [basis.Truncation.PARALLELOGRAMIC]]
+    )
+    def test_unflatten_zero_fill_matches_nan_fill(self, truncation):
+        expansion = basis.generate_expansion(
+            primitive_lattice_vectors=basis.LatticeVectors(basis.X, basis.Y),
+            approximate_num_terms=50,
+            truncation=truncation,
+        )
+        transverse_wavevectors = jax.random.uniform(
+            jax.random.PRNGKey(0), (3, 2, expansion.num_terms, 2)
+        )
+        unflattened = farfield._unflatten_transverse_wavevectors(
+            transverse_wavevectors, expansion, (0, 1), fill_value=0.0
+        )
+        expected = farfield.unflatten_transverse_wavevectors(
+            transverse_wavevectors, expansion, (0, 1)
+        )
+        onp.testing.assert_array_equal(unflattened, jnp.nan_to_num(expected))
+
     @parameterized.parameterized.expand(
         (
             [(4, 5), (0, 1)],
@@ -509,6 +921,43 @@ class UnflattenTest(unittest.TestCase):
         )
         onp.testing.assert_array_equal(expected, unstacked)
 
+    @parameterized.parameterized.expand(
+        (
+            [basis.Truncation.CIRCULAR, (4, 5), (0, 1)],
+            [basis.Truncation.CIRCULAR, (1, 3, 2, 4), (1, 2)],
+            [basis.Truncation.PARALLELOGRAMIC, (4, 5), (0, 1)],
+            [basis.Truncation.PARALLELOGRAMIC, (1, 3, 2, 4), (-5, -4)],
+        )
+    )
+    def test_unflatten_flux_matches_transposed_unflatten(
+        self, truncation, batch_shape, bz_axes
+    ):
+        expansion = basis.generate_expansion(
+            primitive_lattice_vectors=basis.LatticeVectors(basis.X, basis.Y * 3),
+            approximate_num_terms=100,
+            truncation=truncation,
+        )
+        num_sources = 3
+        flux = jax.random.uniform(
+            jax.random.PRNGKey(0),
+            batch_shape + (2 * expansion.num_terms, num_sources),
+        )
+        unstacked = farfield.unflatten_flux(flux, expansion, bz_axes)
+
+        # Compute the expected result by transposing so that the Brillouin zone
+        # and Fourier order axes are trailing, as required by `unflatten`.
+        bz_axes = utils.absolute_axes(bz_axes, flux.ndim)
+        split_flux = flux.reshape(batch_shape + (2, expansion.num_terms, num_sources))
+        batch_axes = tuple(
+            [i for i in range(split_flux.ndim) if i not in bz_axes + (flux.ndim - 1,)]
+        )
+        expected = farfield.unflatten(
+            jnp.transpose(split_flux, batch_axes + bz_axes + (flux.ndim - 1,)),
+            expansion,
+        )
+        expected = jnp.moveaxis(expected, (-4, -3), (-2, -1))
+        onp.testing.assert_array_equal(unstacked, expected)
+
     @parameterized.parameterized.expand(
         (
             [(4, 5), (0, 1)],